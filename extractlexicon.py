@@ -1,14 +1,101 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import pprint
+import functools
+import os
 import xml.etree.ElementTree as ET
-from collections import defaultdict
-from typing import DefaultDict, List, Tuple
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import DefaultDict, Dict, Iterator, List, Mapping, TextIO, Tuple
 
 import postags
 
-PP = pprint.PrettyPrinter()
+# The treebank files making up the training corpus, in the order they are read.
+TREEBANK_DIR = "treebank_data/v1.6/latin/data"
+TREEBANK_FILES = [
+    "1999.02.0010",
+    "2008.01.0002",
+    "2007.01.0001",
+    "1999.02.0060",
+    "phi0448.phi001.perseus-lat1",
+    "phi0620.phi001.perseus-lat1",
+    "phi0959.phi006.perseus-lat1",
+    "phi0690.phi003.perseus-lat1",
+]
+
+# Number of output lines collected before they are handed to writelines().
+WRITE_BATCH_SIZE = 8192
+
+# Treebank lemmas such as "cum#1" or "res publica" become "cum" and "res+publica".
+LEMMA_TRANSLATION = str.maketrans({"#": None, "1": None, " ": "+"})
+
+# lemma_frequency, word_lemma_freq and wordform_to_corpus_lemmas, as gathered by
+# create_training_corpus and written out by create_lemma_frequency_file.
+CorpusFrequencies = Tuple[
+    DefaultDict[str, int],
+    Dict[Tuple[str, str], int],
+    DefaultDict[str, Dict[str, None]],
+]
+
+# Words with one of these postags are left out of the training corpus.
+SKIPPED_POSTAGS = frozenset(("", "_"))
+
+# Cache for dotted_tag(); there are only a few hundred distinct tags.
+DOTTED_TAGS: Dict[str, str] = {}
+
+# Cache for clean_lemma(); the same lemmas recur throughout the treebanks.
+CLEAN_LEMMAS: Dict[str, str] = {}
+
+
+def dotted_tag(tag: str) -> str:
+    """
+    Converts a tag such as "v1spia---" to the RFTagger format "v.1.s.p.i.a.-.-.-".
+    """
+    dotted = DOTTED_TAGS.get(tag)
+    if dotted is None:
+        dotted = DOTTED_TAGS[tag] = ".".join(tag)
+    return dotted
+
+
+def clean_lemma(lemma: str) -> str:
+    """
+    Converts a treebank lemma such as "cum#1" or "res publica" to the form used
+    in the corpus, "cum" or "res+publica".
+    """
+    cleaned = CLEAN_LEMMAS.get(lemma)
+    if cleaned is None:
+        cleaned = CLEAN_LEMMAS[lemma] = lemma.translate(LEMMA_TRANSLATION)
+    return cleaned
+
+
+@contextmanager
+def open_for_replacement(filename: str) -> Iterator[TextIO]:
+    """
+    Opens a temporary file next to `filename` for writing, and moves it into
+    place only once it has been written completely, so that a half-written
+    file is never left behind under the real name.
+    """
+    temp_filename = f"{filename}.tmp"
+    try:
+        with open(temp_filename, "w", encoding="utf-8", buffering=1 << 20) as out_file:
+            yield out_file
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def write_dict_literal(out_file: TextIO, name: str, mapping: Mapping) -> None:
+    """
+    Writes `mapping` to `out_file` as the Python assignment `name = {...}`,
+    one entry per line and sorted by key, so that it can be imported.
+    """
+    out_file.write(f"{name} = {{\n")
+    out_file.writelines(
+        f"    {key!r}: {value!r},\n" for key, value in sorted(mapping.items())
+    )
+    out_file.write("}\n")
 
 
 def create_lexicon_and_endings_data() -> None:
@@ -18,126 +105,210 @@ def create_lexicon_and_endings_data() -> None:
     - Uses that data to create macronized_endings.py.
     """
     print("Generating lexicon and macronized endings...")
+    # Local names for the helpers called in the loops below. The same endings
+    # recur under many tags, so removemacrons is memoized as well.
+    unicodeaccents = postags.unicodeaccents
+    removemacrons = functools.lru_cache(maxsize=None)(postags.removemacrons)
+    escape_macrons = postags.escape_macrons
     tag_to_accents = defaultdict(list)
 
     # First pass: Create the lexicon and gather accent data
-    with open("macrons.txt", "r", encoding="utf-8") as macrons_file, open(
-        "rftagger-lexicon.txt", "w", encoding="utf-8"
-    ) as lexicon_file:
+    with open(
+        "macrons.txt", "r", encoding="utf-8"
+    ) as macrons_file, open_for_replacement("rftagger-lexicon.txt") as lexicon_file:
+        lexicon_lines: List[str] = []
         for line in macrons_file:
             [wordform, tag, lemma, accented] = line.split()
             accented_clean = accented.replace("_^", "").replace("^", "")
-            tag_to_accents[tag].append(postags.unicodeaccents(accented_clean))
+            tag_to_accents[tag].append(unicodeaccents(accented_clean))
             if accented[0].isupper():
                 wordform = wordform.title()
-            tag = ".".join(list(tag))
-            lexicon_file.write(f"{wordform}\t{tag}\t{lemma}\n")
+            tag = dotted_tag(tag)
+            lexicon_lines.append(f"{wordform}\t{tag}\t{lemma}\n")
+            if len(lexicon_lines) >= WRITE_BATCH_SIZE:
+                lexicon_file.writelines(lexicon_lines)
+                lexicon_lines.clear()
+        lexicon_file.writelines(lexicon_lines)
 
     # Second pass: Use the gathered accent data to create the endings file
-    with open("macronized_endings.py", "w", encoding="utf-8") as endings_file:
-        endings_file.write("tag_to_endings = {\n")
-        for tag in sorted(tag_to_accents):
-            ending_freqs: DefaultDict[str, int] = defaultdict(int)
-            for accented in tag_to_accents[tag]:
-                for i in range(1, min(len(accented) - 3, 12)):
-                    ending = accented[-i:]
-                    ending_freqs[ending] += 1
+    with open_for_replacement("macronized_endings.py") as endings_file:
+        endings_lines = ["tag_to_endings = {\n"]
+        for tag, accenteds in sorted(tag_to_accents.items()):
+            # A single Counter over all endings lets the counting run in C.
+            ending_freqs = Counter(
+                accented[-i:]
+                for accented in accenteds
+                for i in range(1, min(len(accented) - 3, 12))
+            )
+            # An ending is relevant if it begins with a long vowel and is more
+            # frequent than its unmacronized counterpart. The default of 1 is
+            # deliberate: when the plain ending never occurs, the macronized one
+            # must still have been seen at least twice.
+            # Collected as (-length, ending) so that a plain sort puts the
+            # longest endings first, alphabetically within each length.
             relevant_endings = []
             for ending in ending_freqs:
-                ending_without_macrons = postags.removemacrons(ending)
+                ending_without_macrons = removemacrons(ending)
                 if ending[0] != ending_without_macrons[0] and ending_freqs[
                     ending
                 ] > ending_freqs.get(ending_without_macrons, 1):
-                    relevant_endings.append(ending)
+                    relevant_endings.append((-len(ending), ending))
+            relevant_endings.sort()
             cleaned_list = [
-                str(postags.escape_macrons(ending))
-                for ending in sorted(relevant_endings, key=lambda x: (-len(x), x))
+                str(escape_macrons(ending)) for _, ending in relevant_endings
             ]
-            endings_file.write(f"  '{tag}': {cleaned_list},\n")
-        endings_file.write("}\n")
+            endings_lines.append(f"  '{tag}': {cleaned_list},\n")
+        endings_lines.append("}\n")
+        endings_file.writelines(endings_lines)
+
+
+def corpus_frequencies(
+    word_lemma_freq: Dict[Tuple[str, str], int],
+) -> CorpusFrequencies:
+    """
+    - Takes the number of times each (word form, lemma) pair occurs in the corpus.
+    - Derives lemma_frequency and wordform_to_corpus_lemmas from it.
+    - Lemmas are kept in order of first occurrence (macronizer.py relies on
+      that order to break ties), using dict keys as an ordered set; a Counter
+      lists its pairs in that order too.
+    """
+    lemma_frequency: DefaultDict[str, int] = defaultdict(int)
+    wordform_to_corpus_lemmas: DefaultDict[str, Dict[str, None]] = defaultdict(dict)
+    for (wordform, lemma), frequency in word_lemma_freq.items():
+        lemma_frequency[lemma] += frequency
+        wordform_to_corpus_lemmas[wordform][lemma] = None
+    return lemma_frequency, word_lemma_freq, wordform_to_corpus_lemmas
+
+
+def heads_next_token(token: ET.Element) -> bool:
+    """
+    Tells whether the head of a treebank word is the word right after it.
+    The ids are only converted for XSEG words, which is all this is needed for.
+    """
+    idnum = token.get("id")
+    head = token.get("head")
+    if idnum is None or head is None:
+        return False
+    return int(head) == int(idnum) + 1
+
+
+def read_treebank(treebank: str) -> Tuple[bytes, Counter]:
+    """
+    - Parses one of the XML treebank files listed in TREEBANK_FILES.
+    - Returns its part of ldt-corpus.txt, encoded as UTF-8, together with the
+      number of times each (word form, lemma) pair occurs in that part.
+    - Runs in a worker process, so it only depends on its argument.
+    """
+    corpus_lines: List[str] = []
+    word_lemma_pairs: List[Tuple[str, str]] = []
+    xsegment = ""
+    xsegmentbehind = ""
+    # Stream the treebank instead of building the whole tree: every child of
+    # the root (normally a <sentence>) is handled and then discarded as soon as
+    # its end tag has been read.
+    depth = 0
+    root = None
+    for event, elem in ET.iterparse(
+        os.path.join(TREEBANK_DIR, f"{treebank}.tb.xml"),
+        events=("start", "end"),
+    ):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        for token in elem.iterfind("word"):
+            relation = token.get("relation", "_")
+            form = token.get("form", "_")
+            lemma = token.get("lemma", form)
+            postag = token.get("postag", "_")
+            if form != "|" and postag not in SKIPPED_POSTAGS:
+                # Word segments (XSEG) pointing at the next word are not
+                # written on their own but glued onto the next word written.
+                if relation == "XSEG" and heads_next_token(token):
+                    if lemma == "other":
+                        xsegment = form
+                        continue
+                    if lemma == "que1" or lemma == "ne1":
+                        xsegmentbehind = form
+                        continue
+                postag = dotted_tag(postag)
+                lemma = clean_lemma(lemma)
+                word = xsegment + form + xsegmentbehind
+                corpus_lines.append(f"{word}\t{postag}\t{lemma}\n")
+                word_lemma_pairs.append((word, lemma))
+                xsegment = ""
+                xsegmentbehind = ""
+        corpus_lines.append(".\tu.-.-.-.-.-.-.-.-\tPERIOD1\n")
+        corpus_lines.append("\n")
+        word_lemma_pairs.append((".", "PERIOD1"))
+        elem.clear()
+        root.remove(elem)
+    # Each file is parsed on its own, so a segment still waiting for its word
+    # here cannot be glued onto the first word of the next file.
+    if xsegment or xsegmentbehind:
+        print(
+            f"Warning: {treebank} ends with unattached word segments:",
+            xsegment,
+            xsegmentbehind,
+        )
+    return "".join(corpus_lines).encode("utf-8"), Counter(word_lemma_pairs)
 
 
-def create_training_corpus() -> None:
+def create_training_corpus() -> CorpusFrequencies:
     """
-    - Parses a hard-coded list of XML treebank files.
+    - Parses the XML treebank files listed in TREEBANK_FILES, in parallel.
     - Processes the tokens and writes them to ldt-corpus.txt.
+    - Counts lemma and word-form frequencies of the written corpus on the way,
+      so that it does not have to be read back in.
     """
     print("Creating training corpus from treebank data...")
-    with open("ldt-corpus.txt", "w", encoding="utf-8") as pos_corpus_file:
-        xsegment = ""
-        xsegmentbehind = ""
-        for f in [
-            "1999.02.0010",
-            "2008.01.0002",
-            "2007.01.0001",
-            "1999.02.0060",
-            "phi0448.phi001.perseus-lat1",
-            "phi0620.phi001.perseus-lat1",
-            "phi0959.phi006.perseus-lat1",
-            "phi0690.phi003.perseus-lat1",
-        ]:
-            bank = ET.parse(f"treebank_data/v1.6/latin/data/{f}.tb.xml")
-            for sentence in bank.getroot():
-                for token in sentence.findall("word"):
-                    idnum = int(token.get("id", "_"))
-                    head = int(token.get("head", "_"))
-                    relation = token.get("relation", "_")
-                    form = token.get("form", "_")
-                    lemma = token.get("lemma", form)
-                    postag = token.get("postag", "_")
-                    if form != "|" and postag != "" and postag != "_":
-                        if (
-                            lemma == "other"
-                            and relation == "XSEG"
-                            and head == idnum + 1
-                        ):
-                            xsegment = form
-                            continue
-                        if (
-                            (lemma == "que1" or lemma == "ne1")
-                            and relation == "XSEG"
-                            and head == idnum + 1
-                        ):
-                            xsegmentbehind = form
-                            continue
-                        postag = ".".join(list(postag))
-                        lemma = (
-                            lemma.replace("#", "").replace("1", "").replace(" ", "+")
-                        )
-                        word = xsegment + form + xsegmentbehind
-                        pos_corpus_file.write(f"{word}\t{postag}\t{lemma}\n")
-                        xsegment = ""
-                        xsegmentbehind = ""
-                pos_corpus_file.write(".\tu.-.-.-.-.-.-.-.-\tPERIOD1\n")
-                pos_corpus_file.write("\n")
-        with open("corpus-supplement.txt", "r", encoding="utf-8") as supplement:
-            for line in supplement:
-                pos_corpus_file.write(line)
-
-
-def create_lemma_frequency_file() -> None:
-    """
-    - Reads the generated ldt-corpus.txt.
-    - Calculates lemma and word-form frequencies.
+    word_lemma_freq: Counter = Counter()
+    # The corpus is written as UTF-8 bytes, which skips the text layer's
+    # per-write encoding; each treebank is encoded once, in its worker.
+    with open("ldt-corpus.txt", "wb", buffering=1 << 20) as pos_corpus_file:
+        # The files are independent of each other; map() hands the results
+        # back in the order of TREEBANK_FILES, so the output does not change.
+        with ProcessPoolExecutor(
+            max_workers=min(len(TREEBANK_FILES), os.cpu_count() or 1)
+        ) as executor:
+            for corpus_data, file_word_lemma_freq in executor.map(
+                read_treebank, TREEBANK_FILES
+            ):
+                pos_corpus_file.write(corpus_data)
+                # Pairs new to the total are appended, so merging in corpus
+                # order keeps the order of first occurrence.
+                word_lemma_freq.update(file_word_lemma_freq)
+        with open("corpus-supplement.txt", "rb") as supplement:
+            supplement_data = supplement.read()
+        pos_corpus_file.write(supplement_data)
+    for line in supplement_data.decode("utf-8").splitlines():
+        if "\t" in line:
+            rest, _, lemma = line.strip().rpartition("\t")
+            word_lemma_freq[(rest.partition("\t")[0], lemma)] += 1
+    return corpus_frequencies(word_lemma_freq)
+
+
+def create_lemma_frequency_file(frequencies: CorpusFrequencies) -> None:
+    """
+    - Takes the frequencies counted by create_training_corpus.
     - Writes the frequency data to lemmas.py.
     """
     print("Creating lemma frequency file...")
-    lemma_frequency: DefaultDict[str, int] = defaultdict(int)
-    word_lemma_freq: DefaultDict[Tuple[str, str], int] = defaultdict(int)
-    wordform_to_corpus_lemmas: DefaultDict[str, List[str]] = defaultdict(list)
-    with open("ldt-corpus.txt", "r", encoding="utf-8") as pos_corpus_file:
-        for line in pos_corpus_file:
-            if "\t" in line:
-                [wordform, _, lemma] = line.strip().split("\t")
-                lemma_frequency[lemma] += 1
-                word_lemma_freq[(wordform, lemma)] += 1
-                if lemma not in wordform_to_corpus_lemmas[wordform]:
-                    wordform_to_corpus_lemmas[wordform].append(lemma)
-    with open("lemmas.py", "w", encoding="utf-8") as lemma_file:
-        lemma_file.write(f"lemma_frequency = {PP.pformat(dict(lemma_frequency))}\n")
-        lemma_file.write(f"word_lemma_freq = {PP.pformat(dict(word_lemma_freq))}\n")
-        lemma_file.write(
-            f"wordform_to_corpus_lemmas = {PP.pformat(dict(wordform_to_corpus_lemmas))}\n"
+    lemma_frequency, word_lemma_freq, wordform_to_corpus_lemmas = frequencies
+    with open_for_replacement("lemmas.py") as lemma_file:
+        write_dict_literal(lemma_file, "lemma_frequency", lemma_frequency)
+        write_dict_literal(lemma_file, "word_lemma_freq", word_lemma_freq)
+        write_dict_literal(
+            lemma_file,
+            "wordform_to_corpus_lemmas",
+            {
+                wordform: list(lemmas)
+                for wordform, lemmas in wordform_to_corpus_lemmas.items()
+            },
         )
 
 
@@ -149,9 +320,9 @@ def main() -> None:
     print("Step 1:")
     create_lexicon_and_endings_data()
     print("Step 2:")
-    create_training_corpus()
+    frequencies = create_training_corpus()
     print("Step 3:")
-    create_lemma_frequency_file()
+    create_lemma_frequency_file(frequencies)
     print("\nAll tasks complete. Required files have been generated.")
 
 
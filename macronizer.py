@@ -282,6 +282,12 @@ prefixeswithshortj = (
     "introj",
 )
 
+# Patterns applied to every token, compiled once instead of being looked up in
+# the re module's cache on each call.
+WORD_START_RE = re.compile(r"[^\W\d_]", flags=re.UNICODE)
+SPACE_START_RE = re.compile(r"\s", flags=re.UNICODE)
+INTERVOCALIC_J_RE = re.compile("([aeiouy])(j[aeiouy])")
+
 
 class Token:
     def __init__(self, text):
@@ -290,8 +296,8 @@ class Token:
         self.accented = [""]
         self.macronized = ""
         self.text = postags.removemacrons(text)
-        self.isword = bool(re.match(r"[^\W\d_]", text, flags=re.UNICODE))
-        self.isspace = bool(re.match(r"\s", text, flags=re.UNICODE))
+        self.isword = bool(WORD_START_RE.match(text))
+        self.isspace = bool(SPACE_START_RE.match(text))
         self.hasenclitic = False
         self.isenclitic = False
         self.startssentence = False
@@ -327,7 +333,7 @@ class Token:
         accented = accented.replace("_^", "").replace("^", "")
         if domacronize and alsomaius and "j" in accented:
             if not accented.startswith(prefixeswithshortj):
-                accented = re.sub("([aeiouy])(j[aeiouy])", r"\1_\2", accented)
+                accented = INTERVOCALIC_J_RE.sub(r"\1_\2", accented)
         if (
             (not domacronize or "_" not in accented)
             and not performutov